@@ -3,16 +3,32 @@ import google.generativeai as genai
 from google.generativeai import types
 from google.generativeai.errors import ResourceExhaustedError, APIError
 import time
-import pandas as pd
+import random
+import threading
+import csv
 import io
 import datetime
+from collections import deque
 
 # --- 설정 및 상수 ---
 CHATBOT_TITLE = "🕵️ 미스터리/역사 속으로! AI 롤플레잉 챗봇"
 DEFAULT_MODEL = "gemini-2.0-flash"
 MODEL_CHOICES = ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-pro"]
+# 모델별 분당 요청 수 상한 (무료 등급 기준, 클라이언트 측 선제 제한에 사용)
+RPM_CAPS = {"gemini-2.0-flash": 15, "gemini-2.5-flash": 10, "gemini-2.5-pro": 5, "gemini-2.5-flash-pro": 5}
+DEFAULT_RPM_CAP = 15
+RATE_LIMIT_WINDOW = 60 # 요청 수를 세는 시간 창(초)
 HISTORY_LIMIT = 6 # 429 에러 발생 시 유지할 최근 대화 턴 수
+MAX_HISTORY_MESSAGES = 40 # API 전송 전 유지할 최대 히스토리 메시지 수 (초과 시 절반으로 줄임)
 RETRY_MAX_ATTEMPTS = 3 # 최대 재시도 횟수
+RETRY_MAX_ATTEMPTS_WITH_HINT = 8 # 서버가 재시도 대기 시간을 알려준 경우의 최대 재시도 횟수
+RETRY_BASE_DELAY = 2 # 지수 백오프 기본 대기 시간(초)
+RETRY_MAX_DELAY = 60 # 재시도 대기 시간 상한(초), 서버 힌트가 이보다 길면 재시도하지 않음
+RETRY_MAX_TOTAL_WAIT = 120 # 메시지 하나당 재시도 대기에 쓸 최대 누적 시간(초)
+RETRY_JITTER = 1.0 # 재시도 동기화를 막기 위한 무작위 지연 최대값(초)
+HISTORY_RENDER_WINDOW = 20 # 재실행마다 화면에 다시 그릴 최근 메시지 수
+CSV_HEADER = ["Role", "Message", "Timestamp"]
+CSV_ROLE_LABELS = {"user": "사용자", "assistant": "챗봇"} # CSV에 기록할 역할 표시 이름
 
 # --- 시스템 프롬프트 ---
 SYSTEM_INSTRUCTION = """
@@ -32,17 +48,25 @@ def get_api_key():
     
     # 2. st.secrets에 없을 경우 임시 입력 UI 표시
     st.info("⚠️ **Streamlit Secrets**에 `GEMINI_API_KEY`가 설정되어 있지 않습니다. 아래 입력창에 **임시** API 키를 입력해주세요.")
-    # API 입력 UI를 별도의 세션 상태 키로 관리하여 재실행 시 상태 유지
-    temp_key = st.text_input("Gemini API Key를 입력하세요:", type="password", key="api_input")
-    return temp_key
+    # 입력 중 글자마다 재실행되지 않도록 폼으로 감싸고, 제출 시에만 키를 세션 상태에 반영
+    with st.form("api_key_form"):
+        temp_key = st.text_input("Gemini API Key를 입력하세요:", type="password", key="api_input")
+        if st.form_submit_button("🔑 연결"):
+            st.session_state.api_key = temp_key
+    return st.session_state.get("api_key")
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_client(api_key):
+    """API 키별로 Gemini 클라이언트를 프로세스당 한 번만 생성하여 공유합니다."""
+    return genai.Client(api_key=api_key)
 
 def initialize_gemini_client(api_key):
     """Gemini 클라이언트를 초기화합니다."""
     try:
         if not api_key:
             return None
-        # 클라이언트 객체를 생성하여 반환합니다.
-        return genai.Client(api_key=api_key)
+        # 캐시된 클라이언트 객체를 반환합니다. (실패 시 예외가 캐시되지 않음)
+        return get_gemini_client(api_key)
     except Exception as e:
         # Streamlit Cloud에서 초기화 오류가 나면 앱이 멈출 수 있으므로 에러만 기록
         print(f"API 클라이언트 초기화 중 오류 발생: {e}")
@@ -66,12 +90,75 @@ def initialize_chat(client, system_instruction, model_name, history):
         st.error(f"채팅 세션 초기화 중 오류 발생: {e}")
         return None
 
+def get_chat_signature(history):
+    """선택된 모델과 히스토리 서명으로 Chat 객체 재생성 필요 여부를 판별하는 서명을 반환합니다."""
+    return (st.session_state.model_name,) + get_history_signature(history)
+
+def rebuild_chat(history):
+    """주어진 히스토리로 Chat 객체를 재생성하고, 그 서명을 기록합니다."""
+    st.session_state.chat = initialize_chat(
+        st.session_state.client,
+        SYSTEM_INSTRUCTION,
+        st.session_state.model_name,
+        history
+    )
+    st.session_state.chat_signature = get_chat_signature(history)
+
+def sync_chat_history(history):
+    """Chat 객체가 없거나 모델/히스토리 서명이 바뀐 경우에만 Chat 객체를 재생성합니다."""
+    if st.session_state.chat is None or st.session_state.chat_signature != get_chat_signature(history):
+        rebuild_chat(history)
+
+def get_context_history():
+    """전체 히스토리 중 Chat 객체에 전달되는 최근 구간을 반환합니다."""
+    return st.session_state.chat_history[st.session_state.context_start:]
+
+def set_context_history(context_history):
+    """마지막 사용자 메시지 직전까지의 최근 구간을 Chat 객체에 전달할 문맥으로 지정합니다.
+
+    화면 표시와 CSV 내보내기용 chat_history/flat_history는 잘라내지 않습니다.
+    """
+    st.session_state.context_start = len(st.session_state.chat_history) - 1 - len(context_history)
+    sync_chat_history(context_history)
+
+def ensure_chat_session():
+    """현재 문맥과 선택된 모델 기준으로 Chat 객체를 필요할 때만 재생성합니다."""
+    sync_chat_history(get_context_history())
+
 def reset_chat_session():
     """대화 세션과 히스토리를 초기화합니다."""
     st.session_state.chat_history = []
+    st.session_state.flat_history = []
+    st.session_state.context_start = 0
+    # 이전 대화로 준비해 둔 CSV가 새 대화의 다운로드로 제공되지 않도록 제거
+    st.session_state.pop("csv_data", None)
+    st.session_state.pop("csv_signature", None)
     # Chat 객체를 None으로 설정하여 main 로직에서 재초기화를 유도
     st.session_state.chat = None
-    st.rerun()
+    st.session_state.chat_signature = None
+
+def render_turn_count(placeholder):
+    """사이드바 placeholder에 현재 대화 턴 수를 표시합니다."""
+    placeholder.info(f"**대화 턴 수:** `{len(st.session_state.chat_history)}`")
+
+def reset_chat_session_and_stop(history_placeholder, turn_count_placeholder):
+    """오류로 대화를 초기화하고, 이미 그려진 이전 대화와 턴 수도 비운 뒤 현재 실행을 중단합니다."""
+    reset_chat_session()
+    history_placeholder.empty()
+    render_turn_count(turn_count_placeholder)
+    # 오류 메시지는 남긴 채 현재 실행만 중단 (추가 재실행을 예약하지 않음)
+    st.stop()
+
+def append_message(content):
+    """Content를 히스토리에 추가하고, 렌더링/내보내기용 평탄화된 사본도 함께 기록합니다."""
+    st.session_state.chat_history.append(content)
+    st.session_state.flat_history.append({
+        # 롤 변환: 'model' -> 'assistant'
+        "role": "assistant" if content.role == "model" else content.role,
+        "text": content.parts[0].text if content.parts and hasattr(content.parts[0], 'text') else "",
+        # 메시지가 추가된 시각을 한 번만 기록
+        "ts": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
 
 def get_chat_history_for_retry(history, limit):
     """429 에러 발생 시, 최근 N턴만 남기고 히스토리를 잘라냅니다."""
@@ -81,22 +168,114 @@ def get_chat_history_for_retry(history, limit):
     # 여기서는 안전하게 이전 history의 일부만 남깁니다.
     return history[-limit:]
 
-def log_conversation_to_csv(chat_history):
-    """대화 히스토리를 Pandas DataFrame으로 변환하여 CSV 형식의 바이트 스트림을 반환합니다."""
-    data = []
-    for message in chat_history:
-        # Content 객체의 role과 parts[0].text를 추출
-        role = "사용자" if message.role == "user" else "챗봇"
-        text = message.parts[0].text if message.parts and hasattr(message.parts[0], 'text') else ""
-        data.append({"Role": role, "Message": text, "Timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+def prune_history(history, max_messages=MAX_HISTORY_MESSAGES):
+    """API 전송 전, 히스토리가 max_messages개를 넘으면 최근 max_messages // 2개로 줄입니다.
+
+    상한까지만 자르면 이후 매 턴마다 다시 잘려 Chat 객체가 매번 재생성되므로,
+    절반까지 줄여 다음 재생성까지 여유를 둡니다.
+    """
+    if len(history) <= max_messages:
+        return history
+    pruned = history[-(max_messages // 2):]
+    # 대화는 사용자 메시지로 시작해야 하므로 앞쪽에 남은 모델 응답은 제거
+    while pruned and pruned[0].role != "user":
+        pruned = pruned[1:]
+    return pruned
+
+def get_history_signature(history):
+    """히스토리의 길이와 마지막 메시지로 변경 여부를 판별하는 가벼운 서명을 반환합니다."""
+    if not history:
+        return (0, None, 0)
+    last = history[-1]
+    text = last.parts[0].text if last.parts and hasattr(last.parts[0], 'text') else ""
+    return (len(history), last.role, hash(text))
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limit_window(api_key, model_name):
+    """API 키와 모델별로 프로세스 전체에서 공유하는 요청 기록(deque)과 잠금을 반환합니다."""
+    return deque(), threading.Lock()
+
+def wait_for_rate_limit(api_key, model_name):
+    """같은 API 키로 최근 1분간 보낸 요청 수가 모델 상한에 도달했으면 창이 비워질 때까지 대기한 뒤 요청을 기록합니다."""
+    # 할당량은 API 키 단위로 적용되므로, 같은 키를 쓰는 모든 세션/탭이 하나의 창을 공유
+    req_times, lock = get_rate_limit_window(api_key, model_name)
+    rpm_cap = RPM_CAPS.get(model_name, DEFAULT_RPM_CAP)
+
+    while True:
+        with lock:
+            # 시간 창을 벗어난 오래된 요청 기록 제거
+            now = time.monotonic()
+            while req_times and now - req_times[0] >= RATE_LIMIT_WINDOW:
+                req_times.popleft()
+
+            if len(req_times) < rpm_cap:
+                req_times.append(now)
+                return
+            wait_seconds = RATE_LIMIT_WINDOW - (now - req_times[0])
+
+        # 잠금을 놓은 채 대기하고, 다른 세션과 경쟁할 수 있으므로 깨어난 뒤 다시 확인
+        with st.spinner(f"⏳ 분당 요청 한도({rpm_cap}회)에 도달하여 {wait_seconds:.0f}초 대기 중입니다..."):
+            time.sleep(wait_seconds)
+
+def parse_retry_seconds(value):
+    """'37s' 문자열, Duration 객체(seconds/nanos) 또는 숫자로 된 대기 시간을 초 단위로 변환합니다."""
+    try:
+        if isinstance(value, str):
+            return float(value.strip().rstrip('s'))
+        if hasattr(value, 'seconds'):
+            return value.seconds + getattr(value, 'nanos', 0) / 1e9
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
 
-    df = pd.DataFrame(data)
-    
-    # CSV 파일로 인코딩 (UTF-8, BOM 포함하여 한글 깨짐 방지)
-    csv_buffer = io.StringIO()
-    # encoding='utf-8-sig'를 사용하여 BOM을 추가해 엑셀에서 한글 깨짐 방지
-    df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
-    return csv_buffer.getvalue().encode('utf-8-sig')
+def get_retry_hint(error):
+    """429 에러에 서버가 알려준 재시도 대기 시간(초)이 있으면 반환합니다.
+
+    google-genai(0.1.0)의 APIError에는 retry_delay 속성이 없고, details 목록의
+    google.rpc.RetryInfo 항목('retryDelay': '37s')에 값이 담깁니다.
+    google-api-core 예외의 retry_delay 속성(Duration)도 함께 확인합니다.
+    """
+    candidates = [getattr(error, 'retry_delay', None)]
+    for detail in getattr(error, 'details', None) or []:
+        if isinstance(detail, dict):
+            if detail.get('@type', '').endswith('google.rpc.RetryInfo'):
+                candidates.append(detail.get('retryDelay'))
+        else:
+            candidates.append(getattr(detail, 'retry_delay', None))
+
+    for candidate in candidates:
+        seconds = parse_retry_seconds(candidate)
+        if seconds:
+            return seconds
+    return None
+
+def get_retry_delay(attempt, retry_hint=None):
+    """서버 힌트를 우선 사용하고, 없으면 지터를 더한 지수 백오프 대기 시간을 계산합니다.
+
+    서버 힌트가 RETRY_MAX_DELAY보다 길면 일찍 재시도해도 다시 429가 나므로 None을 반환합니다.
+    """
+    if retry_hint:
+        return retry_hint if retry_hint <= RETRY_MAX_DELAY else None
+    return min(RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, RETRY_JITTER), RETRY_MAX_DELAY)
+
+def log_conversation_to_csv(flat_history):
+    """대화 히스토리를 csv 모듈로 직접 인코딩하여 CSV 형식의 바이트 스트림을 반환합니다."""
+    # encoding='utf-8-sig'로 BOM을 추가해 엑셀에서 한글 깨짐 방지
+    csv_buffer = io.BytesIO()
+    text_stream = io.TextIOWrapper(csv_buffer, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text_stream)
+    writer.writerow(CSV_HEADER)
+    for entry in flat_history:
+        writer.writerow([
+            CSV_ROLE_LABELS.get(entry["role"], entry["role"]),
+            entry["text"],
+            entry["ts"]
+        ])
+
+    text_stream.flush()
+    # 래퍼가 해제될 때 바이트 버퍼까지 닫히지 않도록 분리
+    text_stream.detach()
+    return csv_buffer.getvalue()
 
 # --- Streamlit UI 및 메인 로직 ---
 
@@ -108,14 +287,18 @@ st.title(CHATBOT_TITLE)
 # =================================================================
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+if "flat_history" not in st.session_state:
+    st.session_state.flat_history = []
 if "model_name" not in st.session_state:
     st.session_state.model_name = DEFAULT_MODEL
 if "client" not in st.session_state:
     st.session_state.client = None
 if "chat" not in st.session_state:
     st.session_state.chat = None
-if "last_api_key" not in st.session_state:
-    st.session_state.last_api_key = None
+if "chat_signature" not in st.session_state:
+    st.session_state.chat_signature = None
+if "context_start" not in st.session_state:
+    st.session_state.context_start = 0
 if "log_enabled" not in st.session_state:
     st.session_state.log_enabled = True
 
@@ -126,59 +309,45 @@ if "log_enabled" not in st.session_state:
 
 api_key = get_api_key()
 
-# API 키 변경 또는 클라이언트가 없을 경우 클라이언트 초기화
-if api_key and (st.session_state.client is None or st.session_state.last_api_key != api_key):
-    st.session_state.client = initialize_gemini_client(api_key)
-    st.session_state.last_api_key = api_key
-    # 클라이언트가 바뀌었으므로 채팅 객체도 초기화
-    st.session_state.chat = initialize_chat(
-        st.session_state.client, 
-        SYSTEM_INSTRUCTION, 
-        st.session_state.model_name, 
-        st.session_state.chat_history
-    )
+# 캐시된 클라이언트를 가져오고, API 키 변경으로 클라이언트가 바뀐 경우에만 채팅 객체 재생성
+client = initialize_gemini_client(api_key)
+if client is not None and client is not st.session_state.client:
+    st.session_state.client = client
+    rebuild_chat(get_context_history())
 
 # 클라이언트가 없으면 앱 중지
-if not st.session_state.client:
+if not client:
     st.error("Gemini API 클라이언트 초기화에 실패했습니다. 유효한 API 키를 입력해주세요.")
     st.stop()
 
 
 # 모델이 바뀌었거나 Chat 객체가 없을 경우 초기화
-if st.session_state.chat is None or st.session_state.chat.model_name != st.session_state.model_name:
-    st.session_state.chat = initialize_chat(
-        st.session_state.client, 
-        SYSTEM_INSTRUCTION, 
-        st.session_state.model_name, 
-        st.session_state.chat_history
-    )
+ensure_chat_session()
 
 
 # =================================================================
 # 3. 사이드바 설정 (UI)
 # =================================================================
 
-with st.sidebar:
-    st.header("⚙️ 설정")
-    
-    # 모델 선택 (세션 상태 model_name에 바인딩)
-    st.session_state.model_name = st.selectbox(
+@st.fragment
+def render_model_settings():
+    """모델 선택과 세션 정보를 렌더링합니다. 모델 변경 시 이 fragment와 채팅 세션 초기화만 재실행됩니다."""
+    # 모델 선택 (세션 상태 model_name에 직접 바인딩)
+    st.selectbox(
         "사용할 기본 모델 선택",
         options=MODEL_CHOICES,
-        index=MODEL_CHOICES.index(DEFAULT_MODEL),
-        key="model_select",
-        on_change=lambda: st.session_state.update(chat=None) # 모델 변경 시 chat 객체 재초기화 유도
+        key="model_name"
     )
+    # 모델이 바뀌었으면 전체 스크립트 재실행 없이 Chat 객체만 재생성
+    ensure_chat_session()
 
-    st.markdown("---")
-    
-    # 대화 초기화 버튼
-    if st.button("🗑️ 대화 초기화", help="현재 대화 기록을 모두 지우고 세션을 새로 시작합니다."):
-        reset_chat_session()
+    # 세션 정보 표시
+    st.subheader("세션 정보")
+    st.info(f"**모델:** `{st.session_state.model_name}`")
 
-    st.markdown("---")
-    
-    # 로그 기록 옵션 및 다운로드
+@st.fragment
+def render_log_settings():
+    """로그 기록 옵션과 CSV 다운로드를 렌더링합니다. 로그 준비 클릭 시 이 fragment만 재실행됩니다."""
     st.session_state.log_enabled = st.checkbox(
         "💾 CSV 로그 자동 기록", 
         value=st.session_state.log_enabled, # 초기화된 값 사용
@@ -186,25 +355,53 @@ with st.sidebar:
         help="모든 대화를 세션 종료 시 자동으로 CSV 파일로 저장합니다."
     )
     
-    # 대화 히스토리가 있을 경우 다운로드 버튼 표시
+    # 대화 히스토리가 있을 경우 로그 준비 버튼 표시 (클릭 시에만 CSV 생성)
     if st.session_state.chat_history:
-        try:
-            csv_data = log_conversation_to_csv(st.session_state.chat_history)
+        history_signature = get_history_signature(st.session_state.chat_history)
+
+        # 히스토리가 바뀌면 이전에 준비한 로그는 무효화
+        if st.session_state.get("csv_signature") != history_signature:
+            st.session_state.pop("csv_data", None)
+
+        if st.button("📦 로그 준비", help="현재까지의 대화 내용으로 CSV 파일을 준비합니다."):
+            try:
+                st.session_state.csv_data = log_conversation_to_csv(st.session_state.flat_history)
+                st.session_state.csv_signature = history_signature
+            except Exception as e:
+                st.error(f"로그 다운로드 준비 중 오류 발생: {e}")
+
+        if "csv_data" in st.session_state:
             st.download_button(
                 label="⬇️ 대화 로그 다운로드 (.csv)",
-                data=csv_data,
+                data=st.session_state.csv_data,
                 file_name=f"history_log_{datetime.date.today()}_{datetime.datetime.now().strftime('%H%M%S')}.csv",
                 mime="text/csv",
-                help="현재까지의 대화 내용을 CSV 파일로 다운로드합니다."
+                help="준비된 대화 내용을 CSV 파일로 다운로드합니다."
             )
-        except Exception as e:
-             st.error(f"로그 다운로드 준비 중 오류 발생: {e}")
+
+with st.sidebar:
+    st.header("⚙️ 설정")
+    
+    # fragment 내부의 위젯 변경은 메인 채팅 영역을 다시 그리지 않음
+    render_model_settings()
+    # 대화 턴 수는 응답 완료/오류 초기화 시 바로 갱신할 수 있도록 fragment 밖의 placeholder에 표시
+    turn_count_placeholder = st.empty()
+    render_turn_count(turn_count_placeholder)
 
     st.markdown("---")
+    
+    # 대화 초기화 버튼 (메인 채팅 영역도 비워야 하므로 fragment 밖에 둠)
+    # 콜백은 스크립트 재실행 전에 호출되므로 별도의 st.rerun() 없이 초기화된 상태로 렌더링됨
+    st.button(
+        "🗑️ 대화 초기화",
+        help="현재 대화 기록을 모두 지우고 세션을 새로 시작합니다.",
+        on_click=reset_chat_session
+    )
 
-    # 세션 정보 표시
-    st.subheader("세션 정보")
-    st.info(f"**모델:** `{st.session_state.model_name}`\n\n**대화 턴 수:** `{len(st.session_state.chat_history)}`")
+    st.markdown("---")
+    
+    # 로그 기록 옵션 및 다운로드
+    render_log_settings()
 
 
 # =================================================================
@@ -212,11 +409,23 @@ with st.sidebar:
 # =================================================================
 
 # 기존 대화 히스토리 표시
-for message in st.session_state.chat_history:
-    # 롤 변환: 'model' -> 'assistant'
-    role = "assistant" if message.role == "model" else message.role
-    with st.chat_message(role):
-        st.markdown(message.parts[0].text)
+# Streamlit은 매 재실행마다 다시 그리지 않은 요소를 지우므로, 최근 메시지만 기본으로 그리고
+# 그 이전 메시지는 사용자가 펼칠 때만 그려 재실행 비용을 전체 길이와 무관하게 유지
+# 오류로 대화를 초기화할 때 이미 그려진 메시지를 지울 수 있도록 placeholder 안에 렌더링
+history_placeholder = st.empty()
+with history_placeholder.container():
+    hidden_count = max(len(st.session_state.flat_history) - HISTORY_RENDER_WINDOW, 0)
+    render_start = hidden_count
+    if hidden_count:
+        # 위젯 라벨이 바뀌면 토글 상태가 초기화되므로 라벨은 고정하고 개수는 별도로 표시
+        st.caption(f"최근 {HISTORY_RENDER_WINDOW}개 이전의 대화 {hidden_count}개가 숨겨져 있습니다.")
+        if st.toggle("📜 이전 대화 보기", key="show_older_history"):
+            render_start = 0
+
+    # 추가 시점에 평탄화해 둔 사본을 사용하므로 재실행마다 Content 속성에 접근하지 않음
+    for entry in st.session_state.flat_history[render_start:]:
+        with st.chat_message(entry["role"]):
+            st.markdown(entry["text"])
 
 # 사용자 입력 처리
 if prompt := st.chat_input("미스터리 또는 역사를 물어보세요..."):
@@ -227,63 +436,83 @@ if prompt := st.chat_input("미스터리 또는 역사를 물어보세요..."):
 
     # 히스토리에 사용자 메시지 추가
     user_content = types.Content(role="user", parts=[types.Part.from_text(prompt)])
-    st.session_state.chat_history.append(user_content)
+    append_message(user_content)
+
+    # 전송 전에 Chat 객체에 보낼 문맥 길이를 제한하고, 잘린 경우에만 Chat 객체를 한 번 재생성
+    set_context_history(prune_history(get_context_history()[:-1]))
 
     # 챗봇 응답 생성 및 429 에러 처리 로직
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
-        full_response = ""
         
         # 429 재시도 로직
-        for attempt in range(RETRY_MAX_ATTEMPTS):
+        attempt = 0
+        max_attempts = RETRY_MAX_ATTEMPTS
+        total_retry_wait = 0
+        while attempt < max_attempts:
             try:
+                # 분당 요청 한도를 넘지 않도록 필요 시 미리 대기
+                wait_for_rate_limit(api_key, st.session_state.model_name)
+
                 # Chat 객체의 send_message를 사용 (재시도 시 히스토리 자동 관리)
                 response = st.session_state.chat.send_message(prompt, stream=True)
-                for chunk in response:
-                    full_response += chunk.text
-                    message_placeholder.markdown(full_response + "▌")
-                message_placeholder.markdown(full_response)
+                # st.write_stream이 조각 단위로 화면을 갱신하고 전체 응답 문자열을 반환
+                # (재시도 시 이전 시도의 출력을 덮어쓰도록 placeholder 내부에 렌더링)
+                # 빈 조각이나 None이 섞이면 문자열 대신 리스트가 반환되므로 텍스트가 있는 조각만 전달
+                with message_placeholder.container():
+                    full_response = st.write_stream(chunk.text for chunk in response if chunk.text)
+                if not isinstance(full_response, str):
+                    # 조각이 하나도 없는 경우(예: 안전 필터로 차단된 응답)는 히스토리에 넣지 않고 오류로 처리
+                    raise ValueError("모델이 빈 응답을 반환했습니다")
 
                 # 성공 시 챗봇 응답을 히스토리에 추가하고 루프 종료
                 model_content = types.Content(role="model", parts=[types.Part.from_text(full_response)])
-                st.session_state.chat_history.append(model_content)
+                append_message(model_content)
+                # Chat 객체도 이번 턴을 히스토리에 포함하므로 서명 갱신
+                st.session_state.chat_signature = get_chat_signature(get_context_history())
+                render_turn_count(turn_count_placeholder)
                 break 
 
-            except ResourceExhaustedError:
-                if attempt < RETRY_MAX_ATTEMPTS - 1:
-                    st.warning(f"⚠️ **429 Rate Limit Exceeded** 발생. 잠시 후 재시도합니다. (시도 {attempt + 1}/{RETRY_MAX_ATTEMPTS})")
-                    
-                    # 1. Chat History를 최근 6턴만 남기고 잘라냅니다.
-                    new_history = get_chat_history_for_retry(st.session_state.chat_history[:-1], HISTORY_LIMIT) # 마지막 사용자 메시지 제외
-                    st.session_state.chat_history = new_history
+            except ResourceExhaustedError as e:
+                # 서버가 대기 시간을 알려준 경우 재시도 비용이 낮으므로 더 많이 시도
+                retry_hint = get_retry_hint(e)
+                if retry_hint:
+                    max_attempts = RETRY_MAX_ATTEMPTS_WITH_HINT
+                retry_delay = get_retry_delay(attempt, retry_hint)
+
+                # 서버 힌트가 상한을 넘거나 누적 대기 시간이 한도를 넘으면 바로 포기
+                can_retry = (
+                    attempt < max_attempts - 1
+                    and retry_delay is not None
+                    and total_retry_wait + retry_delay <= RETRY_MAX_TOTAL_WAIT
+                )
+                if can_retry:
+                    st.warning(f"⚠️ **429 Rate Limit Exceeded** 발생. 잠시 후 재시도합니다. (시도 {attempt + 1}/{max_attempts})")
                     
-                    # 2. 새로운 (축약된) 히스토리로 Chat 객체 재생성
-                    st.session_state.chat = initialize_chat(
-                        st.session_state.client, 
-                        SYSTEM_INSTRUCTION, 
-                        st.session_state.model_name, 
-                        st.session_state.chat_history
-                    )
+                    # 1. Chat 객체에 보낼 문맥을 최근 6턴만 남기고 잘라냅니다. (화면/로그용 히스토리는 유지)
+                    # 2. 문맥이 실제로 바뀐 경우에만 Chat 객체 재생성
+                    set_context_history(get_chat_history_for_retry(get_context_history()[:-1], HISTORY_LIMIT))
                     
-                    # 3. 지수 백오프 방식의 대기 (2초, 4초)
-                    time.sleep(2 ** (attempt + 1)) 
+                    # 3. 서버 힌트 또는 지터를 더한 지수 백오프 방식의 대기
+                    with st.spinner(f"⏳ {retry_delay:.0f}초 후 재시도합니다..."):
+                        time.sleep(retry_delay)
+                    total_retry_wait += retry_delay
                     
-                    # 4. 재시도 시, 잘려나간 히스토리에 현재 사용자 메시지를 다시 추가
-                    st.session_state.chat_history.append(user_content)
+                    attempt += 1
                     continue
                 else:
-                    st.error("❌ **Rate Limit Exceeded**: 할당량 초과. 더 이상 재시도할 수 없습니다. 대화를 초기화합니다.")
-                    reset_chat_session()
-                    break
+                    if retry_hint and retry_delay is None:
+                        st.error(f"❌ **Rate Limit Exceeded**: 서버가 {retry_hint:.0f}초 후 재시도를 요청했습니다. 잠시 후 다시 시도해주세요. 대화를 초기화합니다.")
+                    else:
+                        st.error("❌ **Rate Limit Exceeded**: 할당량 초과. 더 이상 재시도할 수 없습니다. 대화를 초기화합니다.")
+                    reset_chat_session_and_stop(history_placeholder, turn_count_placeholder)
 
             except APIError as e:
                 st.error(f"❌ **API 오류 발생**: {e}. 대화를 초기화합니다.")
-                reset_chat_session()
-                break
+                reset_chat_session_and_stop(history_placeholder, turn_count_placeholder)
 
             except Exception as e:
                 st.error(f"❌ **예상치 못한 오류 발생**: {e}. 대화를 초기화합니다.")
-                reset_chat_session()
-                break
+                reset_chat_session_and_stop(history_placeholder, turn_count_placeholder)
 
 